@@ -0,0 +1,7 @@
+# Run with: gunicorn main:app
+# One uvicorn event loop per core, so large uploads are parsed in parallel
+import multiprocessing
+
+bind = "0.0.0.0:8000"
+workers = multiprocessing.cpu_count()
+worker_class = "uvicorn_worker.UvicornWorker"
@@ -1,143 +1,166 @@
 import os
 import uuid
-import asyncio
-from typing import Dict, AsyncGenerator
+from typing import AsyncGenerator, Optional
 
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import JSONResponse, StreamingResponse
+import anyio
+import orjson
 
-import assemblyai as aai
-from utils import save_file, extract_audio, transcribe_audio   # 👈 import helpers
+from fastapi import FastAPI, File, Request, UploadFile
+from fastapi.responses import Response, StreamingResponse
+from pydantic import BaseModel
+from starlette.formparsers import MultiPartParser
+
+from utils import VIDEO_HEADER_SIZE, looks_like_video, save_file   # 👈 import helpers
+from store import data_path, save_job, get_job, jobs_snapshot, enqueue_processing, next_event, pending_events, drop_events
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-ASSEMBLYAI_API_KEY = os.getenv("ASSEMBLYAI_API_KEY")
-if not ASSEMBLYAI_API_KEY:
-    raise RuntimeError("ASSEMBLYAI_API_KEY not set in environment variables")
-aai.settings.api_key = ASSEMBLYAI_API_KEY
-config = aai.TranscriptionConfig(speech_model=aai.SpeechModel.best)
-
-
-
 app = FastAPI()
 
+# Keep uploads up to this size in memory instead of spooling them to disk (Starlette
+# defaults to 1 MB), so they are written to disk once by save_file rather than twice.
+# Every in-flight upload may hold this much RAM; lower it on small machines.
+UPLOAD_SPOOL_MAX_SIZE = int(os.getenv("UPLOAD_SPOOL_MAX_SIZE", 256 * 1024 * 1024))
+MultiPartParser.spool_max_size = UPLOAD_SPOOL_MAX_SIZE
+
 # Create directories if they don't exist
 UPLOAD_DIR = "uploads"
-AUDIO_DIR = "audios"
 TRANSCRIPT_DIR = "transcripts"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-os.makedirs(AUDIO_DIR, exist_ok=True)
-os.makedirs(TRANSCRIPT_DIR, exist_ok=True)
+os.makedirs(data_path(UPLOAD_DIR), exist_ok=True)
+os.makedirs(data_path(TRANSCRIPT_DIR), exist_ok=True)
+# Joined once so each request only formats its job id into the path. Relative to
+# DATA_DIR, which the workers resolve them against too.
+UPLOAD_PREFIX = os.path.join(UPLOAD_DIR, "")
+TRANSCRIPT_PREFIX = os.path.join(TRANSCRIPT_DIR, "")
+
+# How often an idle SSE stream checks whether its client is still there (seconds)
+STREAM_DISCONNECT_POLL = 15.0
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header against an ETag, with weak comparison (RFC 7232)."""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class JobCreated(BaseModel):
+    job_id: str
+    status: str
 
-# In-memory job store (replace with DB/Redis in production)
-jobs: Dict[str, Dict] = {}
+
+def error_response(message: str, status_code: int) -> Response:
+    """Build a JSON error body with orjson."""
+    return Response(
+        content=orjson.dumps({"error": message}), media_type="application/json", status_code=status_code
+    )
 
 
 # ----------------------------
 # API: Create job
 # ----------------------------
 @app.post("/jobs/")
-async def create_job(file: UploadFile = File(...)):
-    if not file.content_type.startswith("video/"):
-        return JSONResponse(content={"error": "Only video files are allowed"}, status_code=400)
+async def create_job(file: UploadFile = File(...)) -> JobCreated:
+    # Sniff the container rather than trusting the client's content type, so bad
+    # uploads are rejected before they are copied into uploads/ or spawn ffmpeg
+    header = await file.read(VIDEO_HEADER_SIZE)
+    await file.seek(0)
+    if not looks_like_video(header):
+        return error_response("Only video files are allowed", 400)
 
     job_id = str(uuid.uuid4())
-    video_path = os.path.join(UPLOAD_DIR, f"{job_id}_{file.filename}")
-    audio_path = os.path.join(AUDIO_DIR, f"{job_id}.mp3")
-    transcript_path = os.path.join(TRANSCRIPT_DIR, f"{job_id}.txt")
-
-    # Create a queue for streaming updates
-    queue: asyncio.Queue[str] = asyncio.Queue()
+    video_path = f"{UPLOAD_PREFIX}{job_id}_{file.filename}"
+    transcript_path = f"{TRANSCRIPT_PREFIX}{job_id}.txt"
 
     # Initialize job state (standardized fields)
-    jobs[job_id] = {
+    job = {
         "id": job_id,
         "status": "pending",
         "video_path": video_path,
-        "audio_path": audio_path,
+        "audio_codec": None,
         "transcript_path": transcript_path,
         "error_message": None,
         "transcript_text": None,
         "steps": [],
-        "queue": queue,   # 👈 store queue
     }
+    await save_job(job)
 
     # Save uploaded file
-    await save_file(file, video_path)
-    jobs[job_id]["steps"].append("Video uploaded")
+    await save_file(file, data_path(video_path))
+    job["steps"].append("Video uploaded")
+    await save_job(job)
 
-    # Run processing in background
-    asyncio.create_task(process_job(job_id))
+    # Hand processing to the worker pool; it survives API restarts
+    await enqueue_processing(job_id)
 
-    return {"job_id": job_id, "status": "pending"}
+    return JobCreated(job_id=job_id, status="pending")
 
 
 # ----------------------------
 # API: Get all jobs
 # ----------------------------
 @app.get("/jobs/")
-async def list_jobs():
+async def list_jobs(request: Request):
     """Return all jobs and their statuses."""
-    return {"jobs": [
-        {k: v for k, v in job.items() if k != "queue"}  # don’t expose queue
-        for job in jobs.values()
-    ]}
+    version, body = await jobs_snapshot()
+
+    headers = {"ETag": f'"{version}"'}
+    if etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
 
 # ----------------------------
 # API: Stream job updates  
 # ----------------------------
-@app.get("/jobs/{job_id}/stream")
-async def stream_job(job_id: str):
-    if job_id not in jobs:
-        return JSONResponse(content={"error": "Job not found"}, status_code=404)
+async def final_event(job_id: str) -> Optional[str]:
+    """Return the job's closing message if it has ended and nothing is left to deliver."""
+    if await pending_events(job_id):
+        return None
+    job = await get_job(job_id)
+    if job is None or job["status"] == "failed":
+        return f"ERROR: {job['error_message'] if job else 'Job not found'}"
+    if job["status"] == "completed":
+        return "Transcription completed"
+    return None
+
 
-    queue: asyncio.Queue[str] = jobs[job_id]["queue"]
+@app.get("/jobs/{job_id}/stream")
+async def stream_job(job_id: str, request: Request):
+    if await get_job(job_id) is None:
+        return error_response("Job not found", 404)
 
     async def event_generator() -> AsyncGenerator[str, None]:
-        while True:
-            message = await queue.get()
-            yield f"data: {message}\n\n"
-            if message == "DONE":
-                break
+        done = False
+        try:
+            # The job may have ended while nobody was listening, its DONE already
+            # consumed or dropped; the job record is the authority on that
+            final = await final_event(job_id)
+            while not done and final is None:
+                message = await next_event(job_id, STREAM_DISCONNECT_POLL)
+                if message is None:
+                    if await request.is_disconnected():
+                        break
+                    final = await final_event(job_id)
+                    continue
+                done = message == "DONE"
+                yield f"data: {message}\n\n"
+
+            if final is not None:
+                done = True
+                yield f"data: {final}\n\n"
+                yield "data: DONE\n\n"
+        finally:
+            if not done:
+                # Client went away: drop its backlog so it can't pin memory. Starlette
+                # cancels the stream on disconnect, so shield the cleanup from it.
+                with anyio.CancelScope(shield=True):
+                    await drop_events(job_id)
 
     return StreamingResponse(event_generator(), media_type="text/event-stream")
 
-
-
-# ----------------------------
-# API: process job 
-# ----------------------------
-async def process_job(job_id: str):
-    job = jobs[job_id]
-    q: asyncio.Queue[str] = job["queue"]
-
-    try:
-        job["status"] = "extracting_audio"
-        job["steps"].append("Extracting audio")
-        await q.put("Extracting audio...")
-        await asyncio.to_thread(extract_audio, job["video_path"], job["audio_path"])
-        await q.put("Audio extracted")
-
-        job["status"] = "transcribing"
-        job["steps"].append("Transcribing")
-        await q.put("Transcribing audio...")
-        transcript = await asyncio.to_thread(
-            transcribe_audio, job["audio_path"], job["transcript_path"], config
-        )
-
-        job["status"] = "completed"
-        job["transcript_text"] = transcript
-        job["steps"].append("Completed")
-
-        await q.put("Transcription completed")
-
-    except Exception as e:
-        job["status"] = "failed"
-        job["error_message"] = str(e)
-        job["steps"].append("Failed")
-        await q.put(f"ERROR: {str(e)}")
-
-    finally:
-        await q.put("DONE")
\ No newline at end of file
@@ -0,0 +1,108 @@
+import os
+import asyncio
+from typing import Dict, Optional, Tuple
+
+import orjson
+import redis.asyncio as redis
+from arq import ArqRedis, create_pool
+from arq.connections import RedisSettings
+from dotenv import load_dotenv
+
+# Loaded here as well because this module is imported before its importers load .env
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Root the API and the workers both resolve job file paths against; job records only
+# hold paths relative to it, so clients never see the server's directory layout
+DATA_DIR = os.path.abspath(os.getenv("DATA_DIR", "."))
+
+# Job state lives in Redis so every worker process sees the same jobs
+JOBS_KEY = "jobs"                   # hash: job id -> serialized job record
+JOBS_VERSION_KEY = "jobs:version"   # bumped on every job change, used as the /jobs/ ETag
+EVENTS_KEY = "jobs:{}:events"       # list: undelivered progress messages of one job
+
+# Progress messages kept per job; the oldest are dropped once a slow client lets it fill up
+JOB_EVENTS_MAXLEN = 64
+# Undelivered progress messages expire this long after the job's last update (seconds).
+# Only a convenience buffer: whether a job has ended is read from its record, so a
+# stream opened after the list expired still gets the outcome and DONE.
+JOB_EVENTS_TTL = 60 * 60
+
+redis_client = redis.from_url(REDIS_URL)
+# Queue processing jobs are handed to the arq workers through (see worker.py)
+_arq_pool: Optional[ArqRedis] = None
+_arq_pool_lock = asyncio.Lock()
+
+# This process's serialized GET /jobs/ body, keyed by the jobs version it was built from
+_jobs_cache: Tuple[Optional[int], bytes] = (None, b"")
+
+
+def data_path(relative_path: str) -> str:
+    """Resolve a path stored in a job record to a file under DATA_DIR."""
+    return os.path.join(DATA_DIR, relative_path)
+
+
+async def save_job(job: Dict):
+    """Store a job record and bump the jobs version."""
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.hset(JOBS_KEY, job["id"], orjson.dumps(job))
+        pipe.incr(JOBS_VERSION_KEY)
+        await pipe.execute()
+
+
+async def get_job(job_id: str) -> Optional[Dict]:
+    """Load a job record, or None if there is no such job."""
+    raw = await redis_client.hget(JOBS_KEY, job_id)
+    return orjson.loads(raw) if raw is not None else None
+
+
+async def jobs_snapshot() -> Tuple[int, bytes]:
+    """Return the current jobs version and the serialized GET /jobs/ body for it."""
+    global _jobs_cache
+    version = int(await redis_client.get(JOBS_VERSION_KEY) or 0)
+    if _jobs_cache[0] != version:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.get(JOBS_VERSION_KEY)
+            pipe.hvals(JOBS_KEY)
+            raw_version, records = await pipe.execute()
+        # Records are stored serialized, so building the body is a plain byte join
+        _jobs_cache = (int(raw_version or 0), b'{"jobs":[' + b",".join(records) + b"]}")
+    return _jobs_cache
+
+
+async def publish_event(job_id: str, message: str):
+    """Append a progress message to the job's stream."""
+    key = EVENTS_KEY.format(job_id)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.rpush(key, message)
+        pipe.ltrim(key, -JOB_EVENTS_MAXLEN, -1)
+        pipe.expire(key, JOB_EVENTS_TTL)
+        await pipe.execute()
+
+
+async def next_event(job_id: str, timeout: float) -> Optional[str]:
+    """Pop the job's next progress message, or return None after timeout seconds."""
+    item = await redis_client.blpop(EVENTS_KEY.format(job_id), timeout=timeout)
+    return item[1].decode("utf-8") if item else None
+
+
+async def pending_events(job_id: str) -> int:
+    """Return how many progress messages are waiting in the job's stream."""
+    return await redis_client.llen(EVENTS_KEY.format(job_id))
+
+
+async def drop_events(job_id: str):
+    """Discard the job's undelivered progress messages."""
+    await redis_client.delete(EVENTS_KEY.format(job_id))
+
+
+async def enqueue_processing(job_id: str):
+    """Queue the job for processing by an arq worker."""
+    global _arq_pool
+    if _arq_pool is None:
+        # Concurrent first requests must not each create (and leak) a pool
+        async with _arq_pool_lock:
+            if _arq_pool is None:
+                _arq_pool = await create_pool(RedisSettings.from_dsn(REDIS_URL))
+    # Using the job id as arq's id keeps a job from being queued twice
+    await _arq_pool.enqueue_job("process_job", job_id, _job_id=job_id)
@@ -1,26 +1,258 @@
+import os
+import json
+import shutil
+import asyncio
 import subprocess
-import assemblyai as aai
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:   # not available on Windows
+    fcntl = None
+
+import httpx
+import aiofiles
 from fastapi import UploadFile
 
-async def save_file(file: UploadFile, destination: str):
-    """Save uploaded file to disk."""
+# Read size for streaming uploads; fewer, larger reads for multi-GB videos
+CHUNK_SIZE = 8 * 1024 * 1024
+
+# Buffer between ffmpeg and the uploader
+PIPE_BUFFER_SIZE = 1024 * 1024
+
+# ioctl request for a copy-on-write clone of a whole file (linux/fs.h)
+FICLONE = 0x40049409
+
+# Audio codecs AssemblyAI accepts as-is, mapped to a streamable muxer they can be copied into
+COPYABLE_AUDIO_FORMATS = {
+    "aac": "adts",
+    "mp3": "mp3",
+    "opus": "ogg",
+    "vorbis": "ogg",
+    "flac": "flac",
+}
+
+# Argument templates for ffmpeg, built once; only paths and stream maps vary per call
+FFMPEG_BASE = ("ffmpeg", "-hide_banner", "-loglevel", "error", "-y")
+# -threads is an input option, so it is repeated before every -i
+FFMPEG_INPUT_ARGS = ("-threads", str(os.cpu_count() or 1), "-i")
+COPY_CODEC_ARGS = ("-acodec", "copy")
+PCM_CODEC_ARGS = ("-acodec", "pcm_s16le", "-ac", "1", "-ar", "16000")
+
+# Bytes of an upload needed to recognize its container (two M2TS packets' sync bytes)
+VIDEO_HEADER_SIZE = 200
+# MPEG transport stream sync byte, repeated every 188 bytes (192 in M2TS/MTS)
+TS_SYNC_BYTE = 0x47
+# Top-level ISO BMFF box types found at offset 4 of MP4/MOV/3GP files
+ISO_BMFF_BOXES = {b"ftyp", b"moov", b"mdat", b"wide", b"free", b"skip", b"pnot"}
+
+# Transcript status polling: check early for short clips, back off for long ones
+POLL_INITIAL_DELAY = 2.0
+POLL_MAX_DELAY = 30.0
+POLL_BACKOFF = 1.5
+
+
+def ffmpeg_debug() -> bool:
+    """Whether FFMPEG_DEBUG is set, i.e. ffmpeg/ffprobe stderr should be kept for error messages."""
+    return bool(os.getenv("FFMPEG_DEBUG"))
+
+
+class FFmpegError(subprocess.CalledProcessError):
+    """A failed ffmpeg/ffprobe run, with its stderr in the message when it was captured."""
+
+    def __str__(self):
+        message = super().__str__()
+        if self.stderr:
+            message = f"{message.rstrip('.')}: {self.stderr.decode('utf-8', 'replace').strip()}"
+        return message
+
+
+def _run_probe(command: List[str]) -> subprocess.CompletedProcess:
+    """Run an ffprobe command and capture its stdout; stderr only when FFMPEG_DEBUG is set."""
+    stderr = subprocess.PIPE if ffmpeg_debug() else subprocess.DEVNULL
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=stderr)
+    if result.returncode:
+        raise FFmpegError(result.returncode, command, stderr=result.stderr)
+    return result
+
+
+def looks_like_video(header: bytes) -> bool:
+    """Tell from the first bytes of a file whether it is in a video container ffmpeg can demux."""
+    return (
+        header[4:8] in ISO_BMFF_BOXES                               # MP4, MOV, 3GP
+        or header.startswith(b"\x1a\x45\xdf\xa3")                   # Matroska, WebM
+        or (header.startswith(b"RIFF") and header[8:12] == b"AVI ")  # AVI
+        or header.startswith(b"\x30\x26\xb2\x75\x8e\x66\xcf\x11")   # ASF, WMV
+        or header.startswith(b"FLV")
+        or header.startswith(b"OggS")                               # Ogg (Theora)
+        or header.startswith(b"\x00\x00\x01\xba")                   # MPEG program stream
+        or header[0:1] == header[188:189] == bytes([TS_SYNC_BYTE])  # MPEG-TS (.ts)
+        or header[4:5] == header[196:197] == bytes([TS_SYNC_BYTE])  # M2TS (.m2ts, .mts)
+    )
+
+
+def fast_copy(src_fd: int, destination: str, size: int):
+    """Copy size bytes from src_fd into destination, keeping the data in the kernel where possible.
+
+    Tries copy_file_range (which reflinks on btrfs/xfs), then a FICLONE reflink, then
+    sendfile, and finally a plain read/write loop for whatever is left.
+    """
+    with open(destination, "wb") as out_file:
+        dst_fd = out_file.fileno()
+        offset = 0
+
+        if hasattr(os, "copy_file_range"):
+            try:
+                while offset < size:
+                    copied = os.copy_file_range(src_fd, dst_fd, size - offset, offset)
+                    if copied == 0:
+                        break
+                    offset += copied
+            except OSError:
+                pass   # e.g. cross-filesystem on older kernels
+            if offset >= size:
+                return
+
+        if offset == 0 and fcntl is not None:
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                return
+            except OSError:
+                pass   # not a reflink-capable filesystem
+
+        if hasattr(os, "sendfile"):
+            try:
+                while offset < size:
+                    sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError:
+                pass
+
+        while offset < size:
+            chunk = os.pread(src_fd, min(CHUNK_SIZE, size - offset), offset)
+            if not chunk:
+                break
+            offset += os.write(dst_fd, chunk)
+
+
+def _copyfileobj(src, destination: str):
+    """Copy an in-memory upload spool to destination in a single C-level loop."""
+    src.seek(0)
     with open(destination, "wb") as out_file:
-        while chunk := await file.read(1024 * 1024):
-            out_file.write(chunk)
+        shutil.copyfileobj(src, out_file, CHUNK_SIZE)
+
+
+async def save_file(file: UploadFile, destination: str):
+    """Save uploaded file to disk without blocking the event loop."""
+    # A spool that rolled over to disk can be copied kernel-side (zero-copy)
+    if getattr(file.file, "_rolled", False) and file.size is not None:
+        await asyncio.to_thread(fast_copy, file.file.fileno(), destination, file.size)
+        return
+
+    await asyncio.to_thread(_copyfileobj, file.file, destination)
+
+def probe_audio_codec(video_path: str) -> Optional[str]:
+    """Return the codec of the first audio stream in the video, or None if it has none."""
+    command = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "a:0", "-show_streams",
+        "-of", "json", video_path,
+    ]
+    result = _run_probe(command)
+    streams = json.loads(result.stdout).get("streams", [])
+    return streams[0].get("codec_name") if streams else None
+
+
+def audio_format(codec: Optional[str]) -> str:
+    """Return the muxer an audio track is written with: its own codec if copyable, else WAV."""
+    if codec is None:
+        raise RuntimeError("Video has no audio track")
+    return COPYABLE_AUDIO_FORMATS.get(codec, "wav")
+
+
+def build_audio_command(tracks: List[Tuple[str, int, Optional[str], str]]) -> List[str]:
+    """Build one ffmpeg command that extracts several audio tracks in a single pass.
+
+    Each track is (video_path, audio_stream_index, codec, output). Every distinct video
+    is demuxed once however many of its tracks are requested. Tracks are stream-copied
+    when their codec fits a streamable container, otherwise decoded to mono 16 kHz PCM,
+    which is what the transcriber ingests natively.
+    """
+    inputs: Dict[str, int] = {}
+    output_args: List[str] = []
+    for video_path, stream_index, codec, output in tracks:
+        input_index = inputs.setdefault(video_path, len(inputs))
+        fmt = audio_format(codec)
+        codec_args = PCM_CODEC_ARGS if fmt == "wav" else COPY_CODEC_ARGS
+        output_args += ["-map", f"{input_index}:a:{stream_index}", *codec_args, "-f", fmt, output]
+
+    command = list(FFMPEG_BASE)
+    for video_path in inputs:
+        command += [*FFMPEG_INPUT_ARGS, video_path]
+    return command + output_args
+
+
+async def _iter_stream(stream: asyncio.StreamReader) -> AsyncIterator[bytes]:
+    """Yield whatever the stream has buffered until it hits EOF."""
+    while chunk := await stream.read(PIPE_BUFFER_SIZE):
+        yield chunk
+
+
+async def extract_and_upload_audio(video_path: str, codec: Optional[str], client: httpx.AsyncClient) -> str:
+    """Pipe the first audio track from ffmpeg straight into an AssemblyAI upload and return its URL.
+
+    Nothing is written to disk, and the upload runs while ffmpeg is still extracting,
+    so the step takes about as long as the slower of the two rather than their sum.
+    """
+    command = build_audio_command([(video_path, 0, codec, "pipe:1")])
+    debug = ffmpeg_debug()
+    # The reader's buffer lets ffmpeg run ahead while the upload waits on the network
+    proc = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE if debug else asyncio.subprocess.DEVNULL,
+        limit=PIPE_BUFFER_SIZE,
+    )
+    try:
+        upload = client.post("/v2/upload", content=_iter_stream(proc.stdout))
+        if debug:
+            # Drain stderr alongside stdout so a chatty ffmpeg can't block on it
+            response, stderr = await asyncio.gather(upload, proc.stderr.read())
+        else:
+            response, stderr = await upload, None
+    except BaseException:
+        # Nobody is draining ffmpeg's stdout any more; don't leave it blocked on it
+        proc.kill()
+        await proc.wait()
+        raise
+
+    if await proc.wait():
+        raise FFmpegError(proc.returncode, command, stderr=stderr)
+    response.raise_for_status()
+    return response.json()["upload_url"]
+
 
-def extract_audio(video_path: str, audio_path: str):
-    """Extract audio track from video using ffmpeg."""
-    command = ["ffmpeg", "-i", video_path, "-vn", "-acodec", "mp3", audio_path]
-    subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+async def transcribe_audio(audio_url: str, transcript_path: str, client: httpx.AsyncClient, ai_config: Dict) -> str:
+    """Transcribe uploaded audio using AssemblyAI, polling its status with exponential backoff."""
+    response = await client.post("/v2/transcript", json={"audio_url": audio_url, **ai_config})
+    response.raise_for_status()
+    transcript = response.json()
 
+    delay = POLL_INITIAL_DELAY
+    while transcript["status"] not in ("completed", "error"):
+        await asyncio.sleep(delay)
+        delay = min(delay * POLL_BACKOFF, POLL_MAX_DELAY)
+        response = await client.get(f"/v2/transcript/{transcript['id']}")
+        response.raise_for_status()
+        transcript = response.json()
 
-def transcribe_audio(audio_path: str, transcript_path: str, ai_config) -> str:
-    """Transcribe audio file using AssemblyAI."""
-    transcript = aai.Transcriber(config=ai_config).transcribe(audio_path)
-    if transcript.status == "error":
-        raise RuntimeError(f"Transcription failed: {transcript.error}")
+    if transcript["status"] == "error":
+        raise RuntimeError(f"Transcription failed: {transcript['error']}")
 
-    with open(transcript_path, "w", encoding="utf-8") as f:
-        f.write(transcript.text)
+    text = transcript["text"] or ""
+    async with aiofiles.open(transcript_path, "w", encoding="utf-8") as f:
+        await f.write(text)
 
-    return transcript.text
\ No newline at end of file
+    return text
\ No newline at end of file
@@ -0,0 +1,126 @@
+import os
+import asyncio
+from typing import Dict
+
+import httpx
+from arq.connections import RedisSettings
+from dotenv import load_dotenv
+
+from utils import probe_audio_codec, extract_and_upload_audio, transcribe_audio
+from store import REDIS_URL, data_path, save_job, get_job, publish_event
+
+# Load environment variables from .env file
+load_dotenv()
+
+ASSEMBLYAI_API_KEY = os.getenv("ASSEMBLYAI_API_KEY")
+if not ASSEMBLYAI_API_KEY:
+    raise RuntimeError("ASSEMBLYAI_API_KEY not set in environment variables")
+ASSEMBLYAI_BASE_URL = "https://api.assemblyai.com"
+config = {"speech_model": "best"}
+
+# Long videos can take a while to transcribe (seconds)
+JOB_TIMEOUT = 3 * 60 * 60
+# Runs of a job, counting reruns after a worker shutdown interrupted it
+MAX_TRIES = 5
+
+# Caps concurrent ffmpeg runs at the core count
+ffmpeg_slots = asyncio.Semaphore(os.cpu_count() or 1)
+
+
+async def advance_job(job: Dict, status: str, step: str):
+    """Move a job to a new status, record the step and persist it."""
+    job["status"] = status
+    job["steps"].append(step)
+    await save_job(job)
+
+
+async def run_job(job: Dict, assemblyai_client: httpx.AsyncClient):
+    """Extract, upload and transcribe one job's video, persisting each step."""
+    job_id = job["id"]
+    video_path = data_path(job["video_path"])
+
+    await advance_job(job, "extracting_audio", "Extracting audio")
+    await publish_event(job_id, "Extracting audio...")
+    job["audio_codec"] = await asyncio.to_thread(probe_audio_codec, video_path)
+    await save_job(job)
+    async with ffmpeg_slots:
+        audio_url = await extract_and_upload_audio(video_path, job["audio_codec"], assemblyai_client)
+    await publish_event(job_id, "Audio extracted")
+
+    await advance_job(job, "transcribing", "Transcribing")
+    await publish_event(job_id, "Transcribing audio...")
+    transcript = await transcribe_audio(
+        audio_url, data_path(job["transcript_path"]), assemblyai_client, config
+    )
+
+    job["transcript_text"] = transcript
+    await advance_job(job, "completed", "Completed")
+
+    await publish_event(job_id, "Transcription completed")
+
+
+async def fail_job(job: Dict, message: str):
+    """Mark a job failed and tell its stream it is over."""
+    job["error_message"] = message
+    await advance_job(job, "failed", "Failed")
+    await publish_event(job["id"], f"ERROR: {message}")
+    await publish_event(job["id"], "DONE")
+
+
+async def requeue_job(job: Dict):
+    """Record that a job was interrupted and will be run again; its stream stays open."""
+    await advance_job(job, "pending", "Interrupted, requeued")
+    await publish_event(job["id"], "Worker stopped, job requeued...")
+
+
+async def process_job(ctx: Dict, job_id: str):
+    job = await get_job(job_id)
+    if job is None:
+        return
+
+    deadline = asyncio.timeout(JOB_TIMEOUT)
+    try:
+        # Our own deadline fires before arq's, so a timed-out job is failed, not left mid-step
+        async with deadline:
+            await run_job(job, ctx["assemblyai_client"])
+    except asyncio.CancelledError:
+        # Worker shutdown: arq runs the job again unless it has used up its tries.
+        # Shielded so the record is updated even if the shutdown cancels us again.
+        if ctx["job_try"] < MAX_TRIES:
+            await asyncio.shield(requeue_job(job))
+        else:
+            await asyncio.shield(fail_job(job, "Job interrupted too many times"))
+        raise
+    except Exception as e:
+        # Only our deadline counts as a job timeout; other TimeoutErrors are plain failures
+        if isinstance(e, TimeoutError) and deadline.expired():
+            await fail_job(job, f"Job timed out after {JOB_TIMEOUT} seconds")
+        else:
+            await fail_job(job, str(e))
+    else:
+        await publish_event(job_id, "DONE")
+
+
+async def startup(ctx: Dict):
+    # One async client per worker so connections are reused across jobs;
+    # no thread is held while an upload or transcription is in flight
+    ctx["assemblyai_client"] = httpx.AsyncClient(
+        base_url=ASSEMBLYAI_BASE_URL,
+        headers={"authorization": ASSEMBLYAI_API_KEY},
+        timeout=httpx.Timeout(30.0),
+    )
+
+
+async def shutdown(ctx: Dict):
+    await ctx["assemblyai_client"].aclose()
+
+
+class WorkerSettings:
+    """Run with: arq worker.WorkerSettings"""
+    functions = [process_job]
+    on_startup = startup
+    on_shutdown = shutdown
+    redis_settings = RedisSettings.from_dsn(REDIS_URL)
+    # Backstop only: process_job enforces JOB_TIMEOUT itself and records the failure
+    job_timeout = JOB_TIMEOUT + 60
+    max_tries = MAX_TRIES